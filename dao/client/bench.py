@@ -0,0 +1,259 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Load generator for the DAO Master task API."""
+
+import json
+import random
+import threading
+import time
+
+from dao.common import exceptions
+from dao.client import router
+from dao.client import utils
+
+
+# Tasks that do not modify master state, with arguments used by dao commands
+READ_TASKS = {
+    'get_env': ((), {}),
+    'worker_list': ((), {}),
+    'sku_list': ((), {}),
+    'network_map_list': ((), {}),
+    'cluster_list': ((False,), {}),
+    'rack_list': ((), dict(detailed=False)),
+    'assets_list': ((), dict(rack_name=None, protected=False, names=[],
+                             serials=[], type_=None)),
+    'servers_list': ((), dict(rack_name=None, cluster_name=None, serials=[],
+                              macs=[], ips=[], names=[], from_status=[],
+                              sku_name=None, detailed=False)),
+}
+DEFAULT_MIX = 'get_env=1,worker_list=1,rack_list=1,sku_list=1'
+# Upper bounds of latency histogram buckets, milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_record_lock = threading.Lock()
+
+
+def record(path, func, args, kwargs):
+    """Append task to the traffic record file, one json per line"""
+    line = json.dumps(dict(ts=time.time(), func=func,
+                           args=list(args), kwargs=kwargs))
+    with _record_lock:
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+
+def parse_mix(mix):
+    """Parse 'func=weight,...' into the list of weighted read tasks"""
+    tasks = list()
+    for item in mix.split(','):
+        func, _, weight = item.strip().partition('=')
+        if func not in READ_TASKS:
+            raise exceptions.DAOException(
+                'Unknown read task {0}. Available: {1}'.format(
+                    func, ', '.join(sorted(READ_TASKS))))
+        try:
+            weight = int(weight or 1)
+        except ValueError:
+            weight = 0
+        if weight < 1:
+            raise exceptions.DAOException(
+                'Weight of {0} should be positive integer'.format(func))
+        args, kwargs = READ_TASKS[func]
+        tasks.append((weight, dict(func=func, args=list(args),
+                                   kwargs=dict(kwargs))))
+    return tasks
+
+
+def load_replay(path):
+    """Load tasks recorded with dao --record.
+    Record time 'ts' is kept to replay tasks with recorded intervals.
+    """
+    tasks = list()
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                task = json.loads(line)
+                tasks.append(dict(func=task['func'],
+                                  args=task.get('args', []),
+                                  kwargs=task.get('kwargs', {}),
+                                  ts=task.get('ts')))
+            except (ValueError, KeyError, TypeError):
+                raise exceptions.DAOException(
+                    '{0}:{1}: invalid task record'.format(path, number))
+    if not tasks:
+        raise exceptions.DAOException('{0}: no tasks recorded'.format(path))
+    return tasks
+
+
+def is_write(task):
+    return task['func'] not in router.IDEMPOTENT_TASKS
+
+
+class _FuncStats(object):
+    def __init__(self):
+        self.latencies = list()
+        self.errors = dict()
+
+    def add(self, latency, error):
+        self.latencies.append(latency)
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def report(self, elapsed):
+        count = len(self.latencies)
+        errors = sum(self.errors.values())
+        histogram = dict()
+        for latency in self.latencies:
+            bucket = next((b for b in BUCKETS if latency <= b), None)
+            name = '<={0}ms'.format(bucket) if bucket else \
+                '>{0}ms'.format(BUCKETS[-1])
+            histogram[name] = histogram.get(name, 0) + 1
+        return dict(requests=count,
+                    errors=self.errors,
+                    error_rate=round(float(errors) / count, 4) if count else 0,
+                    throughput_rps=round(count / elapsed, 2) if elapsed else 0,
+                    latency_ms=utils.latency_summary(self.latencies),
+                    histogram=histogram)
+
+
+class Bench(object):
+    """Send tasks using pool of threads and collect statistics per func.
+
+    send(task) is to return None on success or short error name.
+    With rate set, requests are scheduled at fixed intervals. Recorded
+    traffic without rate set is scheduled at recorded intervals divided by
+    speed. Latency of scheduled requests is measured from the scheduled
+    time, so a slow master is not hidden by the client waiting for it
+    (coordinated omission). Otherwise every thread sends the next task as
+    soon as previous one is completed.
+    """
+
+    def __init__(self, send, tasks, concurrency, rate=None,
+                 duration=None, requests=None, replay=False, speed=1.0):
+        self.send = send
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.speed = speed
+        self._offsets = None
+        if replay:
+            # Recorded traffic is replayed in the recorded order
+            self._tasks = tasks
+            if not rate and all(t.get('ts') is not None for t in tasks):
+                self._offsets = self._replay_offsets(tasks)
+        else:
+            self._weighted = list()
+            for weight, task in tasks:
+                self._weighted.extend([task] * weight)
+            self._tasks = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sent = 0
+        self._stats = dict()
+        self._start = None
+
+    @staticmethod
+    def _replay_offsets(tasks):
+        """Offsets of tasks from the first one and the period of the whole
+        record. Next loop over the record starts one average interval after
+        the last task. None if the record has no duration."""
+        offsets, last = list(), tasks[0]['ts']
+        for task in tasks:
+            # Records appended by parallel dao runs may be slightly unordered
+            last = max(last, task['ts'])
+            offsets.append(last - tasks[0]['ts'])
+        if not offsets[-1]:
+            return None
+        return offsets, offsets[-1] * len(tasks) / (len(tasks) - 1)
+
+    def _next(self):
+        """Return (task, scheduled time) or None if bench is completed"""
+        with self._lock:
+            if self._stop.is_set():
+                return None
+            if self.requests and self._sent >= self.requests:
+                return None
+            if self.rate:
+                scheduled = self._start + self._sent / float(self.rate)
+            elif self._offsets:
+                offsets, period = self._offsets
+                loop, index = divmod(self._sent, len(offsets))
+                scheduled = self._start + \
+                    (loop * period + offsets[index]) / self.speed
+            else:
+                scheduled = time.time()
+            if self.duration and scheduled - self._start >= self.duration:
+                return None
+            if self._tasks is not None:
+                task = self._tasks[self._sent % len(self._tasks)]
+            else:
+                task = random.choice(self._weighted)
+            self._sent += 1
+            return task, scheduled
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            task, scheduled = item
+            delay = scheduled - time.time()
+            if delay > 0:
+                self._stop.wait(delay)
+                if self._stop.is_set():
+                    return
+            try:
+                error = self.send(task)
+            except Exception as exc:
+                error = exc.__class__.__name__
+            latency = (time.time() - scheduled) * 1000
+            with self._lock:
+                self._stats.setdefault(task['func'], _FuncStats()).add(
+                    latency, error)
+
+    def run(self):
+        """Run bench until duration/requests limit or Ctrl+C"""
+        self._start = time.time()
+        threads = [threading.Thread(target=self._worker)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            self._stop.set()
+        return self.report(time.time() - self._start)
+
+    def report(self, elapsed):
+        with self._lock:
+            stats = dict(self._stats)
+        total = _FuncStats()
+        for func_stats in stats.values():
+            total.latencies.extend(func_stats.latencies)
+            for error, count in func_stats.errors.items():
+                total.errors[error] = total.errors.get(error, 0) + count
+        return dict(elapsed_s=round(elapsed, 3),
+                    concurrency=self.concurrency,
+                    target_rate=self.rate,
+                    total=total.report(elapsed),
+                    funcs=dict((func, func_stats.report(elapsed))
+                               for func, func_stats in stats.items()))
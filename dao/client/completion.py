@@ -0,0 +1,297 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Bash completion for dao.
+
+Enable it with:
+    complete -C dao-complete dao
+
+Commands and options are served from the metadata cache which is rebuilt
+from HANDLERS only when shell.py or client.cfg changes. Rack, worker, sku, OS and cluster
+names are served from per location name index, which is refreshed by a
+detached background process when it gets older than NAMES_TTL seconds.
+Neither the dao parser nor the master is touched on the keypress path.
+"""
+
+import getpass
+import json
+import os
+import subprocess
+import sys
+import time
+
+from dao.client import utils
+
+
+META_PATH = os.path.expanduser(os.path.join('~', '.dao', 'completion.json'))
+# Client configuration installed by setup.py. Location and cache directory
+# are taken from it, so metadata is rebuilt when it changes.
+CONFIG_PATH = '/etc/dao/client.cfg'
+NAMES_TTL = 600
+# Master reply timeout for the name index refresh, seconds
+REFRESH_TIMEOUT = 5
+# Refresh lock older than this is considered abandoned. Must stay above the
+# worst refresh time: len(NAME_TASKS) * (connect_timeout + REFRESH_TIMEOUT)
+LOCK_TTL = 300
+# Argument name (dest or option) to the name index it is completed from
+NAME_SOURCES = {
+    'rack': 'racks', 'rack_name': 'racks', '--rack': 'racks',
+    'worker': 'workers', 'worker_name': 'workers', '--worker': 'workers',
+    '--sku': 'skus',
+    '--os-name': 'os', '--set-os-name': 'os',
+    '--cluster': 'clusters', '--set-cluster': 'clusters',
+}
+# Name index: (kind, task, args, kwargs)
+NAME_TASKS = (
+    ('racks', 'rack_list', (), dict(detailed=False)),
+    ('workers', 'worker_list', (), {}),
+    ('skus', 'sku_list', (), {}),
+    ('clusters', 'cluster_list', (False,), {}),
+    ('os', 'os_list', (), dict(worker_name='', os_name='')),
+)
+NO_VALUE_ACTIONS = ('store_true', 'store_false', 'store_const', 'count',
+                    'help', 'version')
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _meta_key():
+    """Metadata is valid while shell.py and client config are unchanged"""
+    return [_mtime(os.path.join(os.path.dirname(__file__), 'shell.py')),
+            _mtime(CONFIG_PATH)]
+
+
+def _argument(names, kwargs):
+    """Describe single cli_argument for completion"""
+    key = names[-1] if names[0].startswith('-') else \
+        kwargs.get('dest', names[0])
+    return dict(value=kwargs.get('action') not in NO_VALUE_ACTIONS,
+                choices=[str(c) for c in kwargs.get('choices') or []],
+                names=NAME_SOURCES.get(key) or
+                NAME_SOURCES.get(kwargs.get('dest')))
+
+
+def build_meta():
+    """Collect commands, options and settings from HANDLERS"""
+    from dao.client import shell
+
+    commands = dict()
+    for name, func in shell.HANDLERS.items():
+        options, positionals = dict(), list()
+        for args, kwargs in getattr(func, 'cli_args', []):
+            if args[0].startswith('-'):
+                for option in args:
+                    options[option] = _argument(args, kwargs)
+            else:
+                positionals.append(_argument(args, kwargs))
+        commands[name] = dict(options=options, positionals=positionals)
+    global_options = dict()
+    for action in shell.get_parser()._actions:
+        for option in action.option_strings:
+            global_options[option] = dict(
+                value=action.nargs != 0,
+                choices=[str(c) for c in action.choices or []],
+                names=None)
+    return dict(key=_meta_key(),
+                commands=commands,
+                options=global_options,
+                location_var=shell.CONF.client.location_var,
+                location=shell.CONF.client.location,
+                cache_dir=os.path.expanduser(shell.CONF.client.snapshot_dir))
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def load_meta():
+    meta = _load(META_PATH)
+    if meta is None or meta.get('key') != _meta_key():
+        meta = build_meta()
+        try:
+            utils.dump_json(META_PATH, meta)
+        except (IOError, OSError):
+            pass
+    return meta
+
+
+def _names_path(meta, location):
+    return os.path.join(meta['cache_dir'],
+                        'names-{0}.json'.format(location.upper()))
+
+
+def _extract_names(result):
+    """Names from the master list result: dict keys or 'name' fields"""
+    if isinstance(result, dict):
+        items = result.values()
+        if not all(isinstance(i, dict) and 'name' in i for i in items):
+            return sorted(unicode(k) for k in result)
+    else:
+        items = result or []
+    return sorted(unicode(i['name'] if isinstance(i, dict) else i)
+                  for i in items)
+
+
+def refresh(location, token):
+    """Fetch names from the master and store the name index.
+    token - content of the refresh lock created for this process.
+    """
+    from dao.client import shell
+
+    meta = load_meta()
+    path = _names_path(meta, location)
+    lock = path + '.lock'
+    try:
+        cli = shell.DAOClient('json', getpass.getuser(), location, None)
+        names = (_load(path) or dict()).get('names', dict())
+        for kind, func, args, kwargs in NAME_TASKS:
+            try:
+                r = cli._request(func, args, kwargs,
+                                 timeout=REFRESH_TIMEOUT, retry=False)
+            except Exception:
+                # Master is slow or not reachable, do not load it more.
+                # Stale names are kept.
+                break
+            if 200 <= r.status_code < 300:
+                try:
+                    names[kind] = _extract_names(r.json()['result'])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    pass
+        cli.router.save_state()
+        utils.dump_json(path, dict(updated=time.time(), names=names))
+    finally:
+        # Lock could be taken over by a newer refresh, keep it then
+        try:
+            with open(lock) as f:
+                owned = f.read() == token
+            if owned:
+                os.remove(lock)
+        except (IOError, OSError):
+            pass
+
+
+def _refresh_in_background(path, location):
+    """Start refresh unless one is already running"""
+    lock = path + '.lock'
+    try:
+        if time.time() - os.path.getmtime(lock) < LOCK_TTL:
+            return
+        os.remove(lock)
+    except OSError:
+        pass
+    token = '{0}-{1}'.format(os.getpid(), time.time())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, token)
+        os.close(fd)
+    except OSError:
+        return
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, '-m', 'dao.client.completion',
+                      '--refresh', location, token],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+
+
+def load_names(meta, location):
+    """Return cached name index, schedule refresh if it is stale"""
+    if not location:
+        return dict()
+    path = _names_path(meta, location)
+    index = _load(path) or dict()
+    if time.time() - index.get('updated', 0) > NAMES_TTL:
+        _refresh_in_background(path, location)
+    return index.get('names', dict())
+
+
+def complete(meta, words, current):
+    """Return completion candidates.
+    words - words before the one being completed, without program name.
+    """
+    location = os.getenv(meta['location_var']) or meta['location']
+    command, positional, value_of = None, 0, None
+    for word in words:
+        if value_of is not None:
+            if value_of == '--location':
+                location = word
+            value_of = None
+            continue
+        options = meta['commands'][command]['options'] if command \
+            else meta['options']
+        if word.startswith('-'):
+            option = options.get(word.partition('=')[0])
+            if option and option['value'] and '=' not in word:
+                value_of = word
+        elif command is None:
+            if word not in meta['commands']:
+                return []
+            command = word
+        else:
+            positional += 1
+
+    if value_of is not None:
+        options = meta['commands'][command]['options'] if command \
+            else meta['options']
+        argument = options.get(value_of)
+    elif current.startswith('-'):
+        options = meta['commands'][command]['options'] if command \
+            else meta['options']
+        candidates = options.keys()
+        argument = None
+    elif command is None:
+        candidates = meta['commands'].keys()
+        argument = None
+    else:
+        positionals = meta['commands'][command]['positionals']
+        argument = positionals[positional] \
+            if positional < len(positionals) else None
+        candidates = []
+
+    if argument is not None:
+        candidates = list(argument['choices'])
+        if argument['names']:
+            names = load_names(meta, location)
+            candidates.extend(names.get(argument['names'], []))
+    return sorted(set(c for c in candidates if c.startswith(current)))
+
+
+def run():
+    """Entry point for bash 'complete -C'.
+    Bash provides the line in COMP_LINE and cursor position in COMP_POINT.
+    """
+    if sys.argv[1:2] == ['--refresh']:
+        refresh(sys.argv[2], sys.argv[3])
+        return
+    line = os.getenv('COMP_LINE', '')
+    line = line[:int(os.getenv('COMP_POINT', len(line)))]
+    words = line.split()
+    current = '' if not words or line[-1:].isspace() else words.pop()
+    meta = load_meta()
+    for candidate in complete(meta, words[1:], current):
+        print candidate.encode('utf-8')
+
+
+if __name__ == '__main__':
+    run()
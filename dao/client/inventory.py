@@ -0,0 +1,370 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Local inventory snapshot.
+
+File layout:
+    header  - struct HEADER: magic, meta offset/length, index offset/length
+    records - one compact json document per line:
+              {"kind": ..., "id": ..., "data": {...}}
+    meta    - json document: location, creation time, record counts
+    index   - sorted lines "<field>\\0<value>\\t<offset>\\t<length>\\n"
+
+The index is sorted, so lookups are a binary search over the memory mapped
+file and only matched records are read and decoded.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+import netaddr
+
+from dao.common import exceptions
+
+
+MAGIC = 'DAOSNAP1'
+HEADER = struct.Struct('>8sQQQQ')
+KINDS = ('server', 'asset', 'rack')
+FIELDS = ('serial', 'mac', 'ip', 'name')
+
+
+def normalize(field, value):
+    """Bring value to the canonical form used by the index"""
+    if isinstance(value, str):
+        # Command line arguments are byte strings
+        value = value.decode('utf-8', 'replace')
+    value = unicode(value).strip()
+    try:
+        if field == 'mac':
+            return str(netaddr.EUI(value,
+                                   dialect=netaddr.mac_unix_expanded))
+        if field == 'ip':
+            return str(netaddr.IPAddress(value.split('/')[0]))
+    except (netaddr.AddrFormatError, ValueError, TypeError):
+        pass
+    # Index lines are tab/newline separated
+    return ' '.join(value.lower().split()).encode('utf-8')
+
+
+def _items(result):
+    """Iterate (id, record) over dict or list result of the master call"""
+    if isinstance(result, dict):
+        return sorted(result.items())
+    return enumerate(result or [])
+
+
+def index_keys(kind, record):
+    """Yield (field, value) pairs to be indexed for the record"""
+    if not isinstance(record, dict):
+        return
+    for key, value in record.items():
+        if value in (None, '') or isinstance(value, (dict, list)):
+            continue
+        key = key.lower()
+        if key == 'name':
+            yield 'name', value
+            if kind == 'asset':
+                # Asset name is equal to serial number
+                yield 'serial', value
+        elif key == 'serial' or key.endswith('_serial'):
+            yield 'serial', value
+        elif key == 'mac' or key.endswith('_mac'):
+            yield 'mac', value
+        elif key == 'ip' or key.endswith('_ip'):
+            yield 'ip', value
+    asset = record.get('asset')
+    if isinstance(asset, dict) and asset.get('serial'):
+        yield 'serial', asset['serial']
+    for iface in record.get('interfaces') or []:
+        if not isinstance(iface, dict):
+            continue
+        if iface.get('mac'):
+            yield 'mac', iface['mac']
+        if iface.get('ip'):
+            yield 'ip', iface['ip']
+
+
+def write(path, location, servers, assets, racks):
+    """Write snapshot file atomically and return its meta"""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    index = set()
+    counts = dict((kind, 0) for kind in KINDS)
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        for kind, result in zip(KINDS, (servers, assets, racks)):
+            for id_, record in _items(result):
+                line = json.dumps(dict(kind=kind, id=id_, data=record),
+                                  separators=(',', ':')) + '\n'
+                offset = f.tell()
+                f.write(line)
+                counts[kind] += 1
+                for field, value in index_keys(kind, record):
+                    index.add('{0}\0{1}\t{2}\t{3}\n'.format(
+                        field, normalize(field, value), offset, len(line)))
+        meta = dict(location=location,
+                    created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                    counts=counts)
+        meta_data = json.dumps(meta)
+        meta_offset = f.tell()
+        f.write(meta_data)
+        index_offset = f.tell()
+        for line in sorted(index):
+            f.write(line)
+        index_length = f.tell() - index_offset
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, meta_offset, len(meta_data),
+                            index_offset, index_length))
+    os.rename(tmp_path, path)
+    return meta
+
+
+class Snapshot(object):
+    """Read only view of the snapshot file backed by mmap"""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise exceptions.DAOException(
+                'Snapshot {0} does not exist. Use dao snapshot to create '
+                'it.'.format(path))
+        self.path = path
+        if os.path.getsize(path) < HEADER.size:
+            # mmap can not map an empty file
+            raise exceptions.DAOException(
+                'Snapshot {0} is corrupted'.format(path))
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, meta_offset, meta_length,
+         self._index_start, index_length) = HEADER.unpack(
+            self._mm[:HEADER.size])
+        if magic != MAGIC:
+            self.close()
+            raise exceptions.DAOException(
+                '{0} is not a DAO snapshot'.format(path))
+        if max(meta_offset + meta_length,
+               self._index_start + index_length) > len(self._mm):
+            self.close()
+            raise exceptions.DAOException(
+                'Snapshot {0} is corrupted'.format(path))
+        self._records_end = meta_offset
+        self._index_end = self._index_start + index_length
+        self.meta = json.loads(self._mm[meta_offset:
+                                        meta_offset + meta_length])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def _read(self, offset, length):
+        return json.loads(self._mm[offset:offset + length])
+
+    def read(self, offset, length):
+        """Read record data by position returned from scan"""
+        return self._read(offset, length)['data']
+
+    def scan(self, kind=None):
+        """Iterate over (offset, length, item) in the order of writing"""
+        offset = HEADER.size
+        while offset < self._records_end:
+            end = self._mm.find('\n', offset, self._records_end)
+            item = self._read(offset, end - offset)
+            if kind is None or item['kind'] == kind:
+                yield offset, end - offset, item
+            offset = end + 1
+
+    def records(self, kind=None):
+        """Iterate over (kind, id, record) in the order of writing"""
+        for _, _, item in self.scan(kind):
+            yield item['kind'], item['id'], item['data']
+
+    def _search(self, key):
+        """Return offset of the first index line with line key >= key"""
+        lo, hi = self._index_start, self._index_end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = max(self._mm.rfind('\n', lo, mid) + 1, lo)
+            end = self._mm.find('\n', start, self._index_end)
+            if self._mm[start:end].split('\t', 1)[0] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def lookup(self, field, value, kind=None):
+        """Return list of (kind, id, record) matched by indexed field"""
+        key = '{0}\0{1}'.format(field, normalize(field, value))
+        offset = self._search(key)
+        found = list()
+        seen = set()
+        while offset < self._index_end:
+            end = self._mm.find('\n', offset, self._index_end)
+            line_key, rec_offset, rec_length = \
+                self._mm[offset:end].split('\t')
+            if line_key != key:
+                break
+            offset = end + 1
+            if rec_offset in seen:
+                continue
+            seen.add(rec_offset)
+            item = self._read(int(rec_offset), int(rec_length))
+            if kind is None or item['kind'] == kind:
+                found.append((item['kind'], item['id'], item['data']))
+        return found
+
+
+def is_snapshot(path):
+    """Check whether file is a snapshot or a saved json result"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def flatten(record, prefix=''):
+    """Flatten nested dicts into {'a.b': value}.
+    Interfaces list is turned into 'interface:<name>' entries the same way
+    dao server-list does it.
+    """
+    flat = dict()
+    if not isinstance(record, dict):
+        flat[prefix or 'value'] = record
+        return flat
+    record = dict(record)
+    for iface in record.pop('interfaces', None) or []:
+        if isinstance(iface, dict) and 'name' in iface:
+            record['interface:%s' % iface['name']] = iface
+    for key, value in record.items():
+        key = '.'.join([prefix, key]) if prefix else key
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, key))
+        else:
+            flat[key] = value
+    return flat
+
+
+def record_key(id_, record, key_field):
+    """Key used to match records: serial, name or result id"""
+    if isinstance(record, dict):
+        if key_field == 'serial':
+            asset = record.get('asset')
+            serial = record.get('serial') or (
+                asset.get('serial') if isinstance(asset, dict) else None)
+            if serial:
+                return serial
+        if key_field in ('serial', 'name') and record.get('name'):
+            return record['name']
+    return id_
+
+
+def _digest(record):
+    return hashlib.md5(json.dumps(flatten(record),
+                                  sort_keys=True)).digest()
+
+
+class _JSONSource(object):
+    """Saved json result, i.e. output of dao server-list --format json"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = json.load(f)
+
+    def items(self):
+        for id_, record in _items(self._data):
+            yield unicode(id_), record, record
+
+    def get(self, ref):
+        return ref
+
+    def close(self):
+        self._data = None
+
+
+class _SnapshotSource(object):
+    """Records of one kind from the snapshot, re-read by offset on demand"""
+
+    def __init__(self, path, kind):
+        self._snapshot = Snapshot(path)
+        self._kind = kind
+
+    def items(self):
+        for offset, length, item in self._snapshot.scan(self._kind):
+            yield unicode(item['id']), item['data'], (offset, length)
+
+    def get(self, ref):
+        return self._snapshot.read(*ref)
+
+    def close(self):
+        self._snapshot.close()
+
+
+def open_source(path, kind='server'):
+    """Open snapshot or saved json result for diff"""
+    if not os.path.exists(path):
+        raise exceptions.DAOException('{0} does not exist'.format(path))
+    if is_snapshot(path):
+        return _SnapshotSource(path, kind)
+    try:
+        return _JSONSource(path)
+    except ValueError:
+        raise exceptions.DAOException(
+            '{0} is neither a snapshot nor a json result'.format(path))
+
+
+def diff(old, new, key_field='serial'):
+    """Compare two sources record by record.
+    Only a digest per old record is kept in memory, records are compared
+    field by field only when digests differ. Yields tuples
+    ('added'|'removed', key, None) and ('changed', key, {field: [old, new]}).
+    Keys used by more than one record on either side can not be matched
+    and are reported once as ('ambiguous', key, None).
+    """
+    seen, ambiguous = dict(), set()
+    for id_, record, ref in old.items():
+        key = record_key(id_, record, key_field)
+        if key in seen:
+            ambiguous.add(key)
+        seen[key] = (_digest(record), ref)
+    # Duplicates in new are to be known before the first record is compared
+    new_keys = set()
+    for id_, record, _ in new.items():
+        key = record_key(id_, record, key_field)
+        if key in new_keys:
+            ambiguous.add(key)
+        new_keys.add(key)
+    del new_keys
+    for key in ambiguous:
+        seen.pop(key, None)
+        yield 'ambiguous', key, None
+    for id_, record, _ in new.items():
+        key = record_key(id_, record, key_field)
+        if key in ambiguous:
+            continue
+        entry = seen.pop(key, None)
+        if entry is None:
+            yield 'added', key, None
+        elif entry[0] != _digest(record):
+            before = flatten(old.get(entry[1]))
+            after = flatten(record)
+            changes = dict((field, [before.get(field), after.get(field)])
+                           for field in set(before) | set(after)
+                           if before.get(field) != after.get(field))
+            yield 'changed', key, changes
+    for key in seen:
+        yield 'removed', key, None
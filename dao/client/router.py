@@ -0,0 +1,341 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Routing of master tasks over several master endpoints.
+
+Endpoints are ordered by health and latency (exponentially weighted moving
+average). Failed endpoints are put aside for an exponentially growing
+period. Endpoint statistics are kept in a small state file, so short lived
+dao invocations benefit from what previous ones learned.
+"""
+
+import collections
+import errno
+import json
+import os
+import Queue
+import random
+import socket
+import threading
+import time
+
+import requests
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    from urllib3.exceptions import NewConnectionError
+
+from dao.common import exceptions
+from dao.client import utils
+
+
+# Tasks which do not change master state and are safe to send twice
+IDEMPOTENT_TASKS = frozenset([
+    'assets_list', 'cluster_list', 'get_env', 'health_check', 'history',
+    'network_map_list', 'objects_list', 'os_list', 'rack_list',
+    'servers_list', 'sku_list', 'worker_list'])
+# Master is overloaded or restarting, other endpoint might answer
+FAILOVER_STATUSES = frozenset([502, 503, 504])
+EWMA_ALPHA = 0.3
+SAMPLES = 50
+# Minimal number of samples to trust endpoint p95 for hedging
+MIN_SAMPLES = 10
+MAX_DOWN_TIME = 60
+
+
+def parse_endpoints(spec, location, default):
+    """Parse 'LOCATION=url, url, ...' into list of urls for location.
+    Urls without location prefix are used for locations without
+    own urls, default url is used if nothing is configured.
+    """
+    own, common = list(), list()
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        prefix, sep, url = item.partition('=')
+        if sep and '://' not in prefix:
+            if prefix.strip().upper() == location:
+                own.append(url.strip())
+        else:
+            common.append(item)
+    return own or common or [default]
+
+
+def not_sent(exc):
+    """Check whether request failed before connection to the master was
+    established, so the task could not reach it."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = exc.args[0] if exc.args else None
+    # urllib3 MaxRetryError keeps the original error as reason
+    reason = getattr(reason, 'reason', reason)
+    if isinstance(reason, NewConnectionError):
+        return True
+    return isinstance(reason, socket.error) and \
+        reason.errno == errno.ECONNREFUSED
+
+
+class Endpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.ewma = None
+        # Latency samples per task: get_env and detailed servers_list
+        # differ by orders of magnitude
+        self.latencies = dict()
+        self.failures = 0
+        self.down_until = 0
+
+    def succeeded(self, func=None, latency=None):
+        """Reset failures. Latency is not recorded if not provided"""
+        self.failures = 0
+        self.down_until = 0
+        if latency is None:
+            return
+        self.latencies.setdefault(
+            func, collections.deque(maxlen=SAMPLES)).append(latency)
+        if self.ewma is None:
+            self.ewma = latency
+        else:
+            self.ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+
+    def failed(self):
+        self.failures += 1
+        self.down_until = time.time() + min(MAX_DOWN_TIME,
+                                            2 ** self.failures)
+
+    def p95(self, func):
+        samples = self.latencies.get(func, ())
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return utils.percentile(list(samples), 95)
+
+    def dump(self):
+        return dict(ewma=self.ewma,
+                    latencies=dict((func, list(samples)) for func, samples
+                                   in self.latencies.items()),
+                    failures=self.failures, down_until=self.down_until)
+
+    def load(self, state):
+        self.ewma = state.get('ewma')
+        latencies = state.get('latencies')
+        # State of older clients keeps one list for all tasks, skip it
+        if isinstance(latencies, dict):
+            for func, samples in latencies.items():
+                self.latencies[func] = collections.deque(samples,
+                                                         maxlen=SAMPLES)
+        self.failures = state.get('failures', 0)
+        self.down_until = state.get('down_until', 0)
+
+
+class Router(object):
+    """Send tasks to the master endpoints with failover.
+
+    Idempotent tasks are retried with jittered exponential backoff and,
+    if hedging is enabled, sent to the second endpoint when the first one
+    does not answer within its p95 latency for the same task. Other tasks fail over only if
+    connection could not be established, so they are never sent twice.
+    """
+
+    def __init__(self, urls, connect_timeout, read_timeout, retries=2,
+                 backoff=0.5, hedge=False, state_path=None):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._load_state()
+
+    @property
+    def urls(self):
+        return [e.url for e in self.endpoints]
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            for endpoint in self.endpoints:
+                if endpoint.url in state:
+                    endpoint.load(state[endpoint.url])
+        except (IOError, ValueError, TypeError, AttributeError):
+            # Broken state file only means statistics are learned again
+            pass
+
+    def save_state(self):
+        """Persist endpoint statistics, errors are ignored"""
+        if not self.state_path:
+            return
+        with self._lock:
+            state = dict((e.url, e.dump()) for e in self.endpoints)
+        try:
+            utils.dump_json(self.state_path, state)
+        except (IOError, OSError):
+            pass
+
+    def _order(self):
+        """Healthy endpoints, picked randomly with weight 1/latency,
+        followed by unhealthy ones, soonest to recover first."""
+        now = time.time()
+        with self._lock:
+            healthy = [e for e in self.endpoints if e.down_until <= now]
+            down = sorted((e for e in self.endpoints if e.down_until > now),
+                          key=lambda e: e.down_until)
+            known = [e.ewma for e in healthy if e.ewma is not None]
+        # Endpoints without statistics are weighted as an average one
+        default = sum(known) / len(known) if known else 1.0
+        order = list()
+        while healthy:
+            weights = [1.0 / max(e.ewma or default, 0.001) for e in healthy]
+            point = random.uniform(0, sum(weights))
+            for index, weight in enumerate(weights):
+                point -= weight
+                if point <= 0:
+                    break
+            order.append(healthy.pop(index))
+        return order + down
+
+    def _send(self, endpoint, func, data, timeout):
+        start = time.time()
+        try:
+            r = requests.post(requests.compat.urljoin(endpoint.url, 'tasks'),
+                              data=data,
+                              headers={'Content-Type': 'application/json'},
+                              timeout=(self.connect_timeout,
+                                       timeout or self.read_timeout))
+        except requests.RequestException as exc:
+            # Reply slower than the caller supplied timeout says nothing
+            # about master health, e.g. the master waits for a slow worker
+            read_timeout = isinstance(exc, requests.Timeout) and \
+                not isinstance(exc, requests.ConnectTimeout)
+            if not (timeout and read_timeout):
+                with self._lock:
+                    endpoint.failed()
+            raise
+        with self._lock:
+            if r.status_code in FAILOVER_STATUSES:
+                endpoint.failed()
+            elif timeout:
+                # Caller bounded requests (health probes, bench) include
+                # worker round-trips or are measured by the caller, keep
+                # them out of ordering and hedging statistics
+                endpoint.succeeded()
+            else:
+                endpoint.succeeded(func, time.time() - start)
+        return r
+
+    def _sequential(self, order, func, data, timeout, idempotent):
+        """Try endpoints one by one. Return (response, error)"""
+        response, error = None, None
+        for endpoint in order:
+            try:
+                response = self._send(endpoint, func, data, timeout)
+            except requests.ConnectionError as exc:
+                if not idempotent and not not_sent(exc):
+                    # Connection dropped after the task was sent, the
+                    # master might be executing it already
+                    raise
+                error = exc
+                continue
+            except requests.RequestException as exc:
+                if not idempotent:
+                    raise exceptions.DAOTimeout(
+                        'DAO Master at {0} did not answer: {1}'.format(
+                            endpoint.url, exc))
+                error = exc
+                continue
+            if response.status_code in FAILOVER_STATUSES and idempotent:
+                continue
+            return response, None
+        return response, error
+
+    def _hedged(self, order, func, data, timeout):
+        """Send to the first endpoint, add the second one if the first
+        exceeds its p95 for the task, fail over to the rest on errors.
+        Return (response, error)"""
+        results = Queue.Queue()
+
+        def send(endpoint):
+            try:
+                results.put((self._send(endpoint, func, data, timeout),
+                             None))
+            except requests.RequestException as exc:
+                results.put((None, exc))
+
+        def launch():
+            thread = threading.Thread(target=send, args=(order.pop(0),))
+            thread.daemon = True
+            thread.start()
+
+        hedge_delay = order[0].p95(func)
+        order = list(order)
+        launch()
+        pending = 1
+        response, error = None, None
+        while pending:
+            try:
+                if hedge_delay is not None and order:
+                    response, error = results.get(timeout=hedge_delay)
+                else:
+                    # Wait with timeout keeps main thread responsive
+                    response, error = results.get(timeout=MAX_DOWN_TIME)
+            except Queue.Empty:
+                if order:
+                    hedge_delay = None
+                    launch()
+                    pending += 1
+                continue
+            pending -= 1
+            if response is not None and \
+                    response.status_code not in FAILOVER_STATUSES:
+                return response, None
+            if order and not pending:
+                launch()
+                pending += 1
+        return response, error
+
+    def post(self, func, data, timeout=None, retry=True):
+        """Send task data to the master and return response.
+        With retry disabled the task is sent to the best endpoint only,
+        without retries, failover and hedging.
+        """
+        idempotent = func in IDEMPOTENT_TASKS
+        attempts = 1 + (self.retries if idempotent and retry else 0)
+        response, error = None, None
+        for attempt in range(attempts):
+            if attempt:
+                # Full jitter exponential backoff
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            order = self._order()
+            if not retry:
+                order = order[:1]
+            if idempotent and retry and self.hedge and len(order) > 1:
+                response, error = self._hedged(order, func, data, timeout)
+            else:
+                response, error = self._sequential(order, func, data,
+                                                   timeout, idempotent)
+            if error is None and response is not None and \
+                    response.status_code not in FAILOVER_STATUSES:
+                return response
+        if response is not None:
+            return response
+        if isinstance(error, requests.Timeout):
+            raise exceptions.DAOTimeout(
+                'DAO Master at {0} could not be reached: {1}'.format(
+                    ', '.join(self.urls), error))
+        raise error
@@ -19,6 +19,7 @@ import netaddr
 import os
 import pprint
 import sys
+import time
 
 from dao.common import config
 
@@ -28,6 +29,10 @@ config.setup('client')
 import requests
 from dao.common import log
 from dao.common import exceptions
+from dao.client import bench
+from dao.client import inventory
+from dao.client import router
+from dao.client import utils
 
 
 opts = [
@@ -37,6 +42,25 @@ opts = [
                   help='Name of the OS variable to use as location'),
     config.StrOpt('client', 'location', default=None,
                   help='Backward compatibility. Location can be configured.'),
+    config.StrOpt('client', 'snapshot_dir', default='~/.dao',
+                  help='Directory to keep local inventory snapshots and '
+                       'master endpoints statistics in.'),
+    config.StrOpt('client', 'master_urls', default='',
+                  help='Comma separated list of DAO Master URLs. URL can be '
+                       'prefixed with location: PHX2=http://host:5000/v1.0. '
+                       'master_url is used if empty.'),
+    config.StrOpt('client', 'connect_timeout', default='5',
+                  help='Timeout in seconds to connect to DAO Master.'),
+    config.StrOpt('client', 'read_timeout', default='300',
+                  help='Timeout in seconds to wait for DAO Master reply.'),
+    config.StrOpt('client', 'retries', default='2',
+                  help='Number of retries for read only tasks.'),
+    config.StrOpt('client', 'retry_backoff', default='0.5',
+                  help='Base delay in seconds between retries. Grows '
+                       'exponentially and is randomized.'),
+    config.StrOpt('client', 'hedge_requests', default='false',
+                  help='Send read only task to the second DAO Master if the '
+                       'first one is slower than its p95 latency.'),
 ]
 config.register(opts)
 CONF = config.get_config()
@@ -85,21 +109,44 @@ class DAOClient(object):
     """
     Class implements general logic to call dao manager and print result
     """
-    def __init__(self, print_format, user, location, parser):
+    def __init__(self, print_format, user, location, parser, record=None,
+                 master_url=None):
         self.print_format = print_format
         self.parser = parser
         self.user = user
+        self.record = record
         # Canonic name format for location is all-caps.
         self.location = location.upper()
-
-    def _call(self, func, *args, **kwargs):
+        if master_url:
+            urls = [master_url]
+        else:
+            urls = router.parse_endpoints(CONF.client.master_urls,
+                                          self.location,
+                                          CONF.client.master_url)
+        self.router = router.Router(
+            urls,
+            connect_timeout=float(CONF.client.connect_timeout),
+            read_timeout=float(CONF.client.read_timeout),
+            retries=int(CONF.client.retries),
+            backoff=float(CONF.client.retry_backoff),
+            hedge=str(CONF.client.hedge_requests).lower() in ('true', '1',
+                                                               'yes'),
+            state_path=os.path.join(
+                os.path.expanduser(CONF.client.snapshot_dir),
+                'endpoints.json'))
+
+    def _request(self, func, args, kwargs, timeout=None, retry=True):
+        """Post task to the master and return raw response"""
         data = dict(func=func,
-                    args=(self.user, self.location) + args,
+                    args=(self.user, self.location) + tuple(args),
                     kwargs=kwargs)
-        r = requests.post(requests.compat.urljoin(CONF.client.master_url,
-                                                  'tasks'),
-                          data=json.dumps(data),
-                          headers={'Content-Type': 'application/json'})
+        return self.router.post(func, json.dumps(data), timeout=timeout,
+                                retry=retry)
+
+    def _call(self, func, *args, **kwargs):
+        if self.record:
+            bench.record(self.record, func, args, kwargs)
+        r = self._request(func, args, kwargs)
         if 200 <= r.status_code < 300:
             return r.json()['result']
         print r.text
@@ -124,10 +171,89 @@ class DAOClient(object):
                            self._call('dhcp_rack_update', args.rack_name))
 
     @cli_command
-    @cli_argument('worker_name', help='Worker name')
+    @cli_argument('worker_name', nargs='?', default=None, help='Worker name')
+    @cli_argument('--all', action='store_true', default=False,
+                  help='Probe all registered workers concurrently')
+    @cli_argument('--timeout', type=float, default=10.0,
+                  help='Optional. Per worker timeout in seconds, used with '
+                       '--all. Default: 10')
+    @cli_argument('--concurrency', type=int, default=16,
+                  help='Optional. Number of workers probed in parallel, used '
+                       'with --all. Default: 16')
+    @cli_argument('--repeat', type=int, default=1,
+                  help='Optional. Number of probe rounds, used with --all. '
+                       '0 means run until interrupted. Default: 1')
+    @cli_argument('--interval', type=float, default=60.0,
+                  help='Optional. Delay in seconds between probe rounds. '
+                       'Default: 60')
+    @cli_usage(['Examples:',
+                ' dao health-check worker1',
+                ' dao health-check --all --timeout 5',
+                ' dao health-check --all --repeat 0 --interval 30'])
     def health_check(self, args):
-        result = self._call('health_check', worker=args.worker_name)
-        self._print_result(args, result)
+        """Check worker health. With --all check every registered worker
+        and report latency percentiles across the fleet."""
+        if args.all == bool(args.worker_name):
+            self.parser.error('Either worker_name or --all should be used')
+        if not args.all:
+            result = self._call('health_check', worker=args.worker_name)
+            self._print_result(args, result)
+            return
+        rounds = 0
+        while True:
+            self._print_result(args, self._health_check_all(args))
+            rounds += 1
+            if args.repeat and rounds >= args.repeat:
+                break
+            sys.stdout.flush()
+            time.sleep(args.interval)
+
+    def _health_check_all(self, args):
+        """Probe all workers in parallel and aggregate the report"""
+        names = self._worker_names(self._call('worker_list'))
+        probes = utils.parallel_map(
+            lambda name: self._health_probe(name, args.timeout),
+            names, args.concurrency)
+        workers = dict()
+        for name, probe in zip(names, probes):
+            if isinstance(probe, Exception):
+                probe = dict(status='error', latency_ms=None,
+                             result=str(probe))
+            workers[name] = probe
+        latencies = [w['latency_ms'] for w in workers.values()
+                     if w['status'] == 'ok']
+        failed = len([w for w in workers.values() if w['status'] != 'ok'])
+        return dict(timestamp=time.strftime('%Y-%m-%d %H:%M:%S'),
+                    total=len(workers),
+                    failed=failed,
+                    latency_ms=utils.latency_summary(latencies),
+                    workers=workers)
+
+    def _health_probe(self, name, timeout):
+        """Call health_check for a single worker and measure round-trip"""
+        start = time.time()
+        try:
+            r = self._request('health_check', (), dict(worker=name),
+                              timeout=timeout, retry=False)
+        except (requests.Timeout, exceptions.DAOTimeout):
+            status, result = 'timeout', None
+        except requests.RequestException as exc:
+            status, result = 'error', str(exc)
+        else:
+            if 200 <= r.status_code < 300:
+                status, result = 'ok', r.json()['result']
+            else:
+                status, result = 'error', r.text
+        latency = round((time.time() - start) * 1000, 3)
+        return dict(status=status, latency_ms=latency, result=result)
+
+    @staticmethod
+    def _worker_names(workers):
+        """Extract worker names from worker_list result"""
+        if isinstance(workers, dict):
+            return sorted(workers.keys())
+        return sorted(w['name'] if isinstance(w, dict) else w
+                      for w in workers)
 
     @cli_command
     @cli_argument('ip', help='IP address of the ToR')
@@ -442,21 +568,30 @@ class DAOClient(object):
 
     @cli_argument('--detailed', action='store_true',
                   help='Extended output, including server network interfaces')
+    @cli_argument('--offline', action='store_true', default=False,
+                  help='Answer from the local snapshot instead of the master. '
+                       'Snapshot is created by dao snapshot command.')
+    @cli_argument('--snapshot', default=None,
+                  help='Optional. Snapshot file to use with --offline.')
     @cli_usage([
         'Example:',
-        'dao server-list --rack PHX2-A1 --status Validating --detailed'])
+        'dao server-list --rack PHX2-A1 --status Validating --detailed',
+        'dao server-list --offline --mac 11:22:33:44:55:66'])
     def server_list(self, args):
         """List servers, using provided filters."""
-        servers = self._call('servers_list',
-                             rack_name=args.rack,
-                             cluster_name=args.cluster,
-                             serials=args.serial,
-                             macs=args.mac,
-                             ips=args.ip,
-                             names=args.name,
-                             from_status=args.status,
-                             sku_name=args.sku,
-                             detailed=args.detailed)
+        if args.offline:
+            servers = self._offline_servers(args)
+        else:
+            servers = self._call('servers_list',
+                                 rack_name=args.rack,
+                                 cluster_name=args.cluster,
+                                 serials=args.serial,
+                                 macs=args.mac,
+                                 ips=args.ip,
+                                 names=args.name,
+                                 from_status=args.status,
+                                 sku_name=args.sku,
+                                 detailed=args.detailed)
         # way to fix unicode
         if isinstance(servers, dict):
             servers = json.loads(json.dumps(servers))
@@ -474,6 +609,103 @@ class DAOClient(object):
                     s[name] = iface
         self._print_result(args, servers)
 
+    def _offline_servers(self, args):
+        """Apply server-list filters to the servers from the snapshot.
+        Serial, MAC, IP and name filters are served by snapshot indexes.
+        """
+        with inventory.Snapshot(self._snapshot_path(args.snapshot)) as snap:
+            servers = None
+            for field, values in (('serial', args.serial), ('mac', args.mac),
+                                  ('ip', args.ip), ('name', args.name)):
+                if not values:
+                    continue
+                matched = dict()
+                for value in values:
+                    for _, id_, server in snap.lookup(field, value, 'server'):
+                        matched[id_] = server
+                if servers is not None:
+                    matched = dict((k, v) for k, v in matched.items()
+                                   if k in servers)
+                servers = matched
+            if servers is None:
+                servers = dict((id_, server) for _, id_, server
+                               in snap.records('server'))
+
+        def related_name(server, attr):
+            value = server.get(attr + '_name') or server.get(attr)
+            if isinstance(value, dict):
+                value = value.get('name')
+            return value
+
+        result = dict()
+        for id_, server in servers.items():
+            if args.status and server.get('status') not in args.status:
+                continue
+            if any(value and related_name(server, attr) != value
+                   for attr, value in (('rack', args.rack), ('sku', args.sku),
+                                       ('cluster', args.cluster))):
+                continue
+            if not args.detailed:
+                server.pop('interfaces', None)
+            result[id_] = server
+        return result
+
+    def _snapshot_path(self, path=None):
+        """Snapshot file for current location unless path is provided"""
+        if path:
+            return path
+        return os.path.join(os.path.expanduser(CONF.client.snapshot_dir),
+                            'snapshot-{0}.snap'.format(self.location))
+
+    @cli_command
+    @cli_argument('--output', default=None,
+                  help='Optional. Snapshot file name. Default: '
+                       'snapshot-<LOCATION>.snap in client.snapshot_dir')
+    @cli_usage(['Snapshot is used by dao lookup and dao server-list '
+                '--offline commands.',
+                'Example:',
+                'dao snapshot --location PHX2'])
+    def snapshot(self, args):
+        """Save servers, assets and racks of location to local snapshot"""
+        path = self._snapshot_path(args.output)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        servers = self._call('servers_list', rack_name=None,
+                             cluster_name=None, serials=[], macs=[], ips=[],
+                             names=[], from_status=[], sku_name=None,
+                             detailed=True)
+        assets = self._call('assets_list', rack_name=None, protected=False,
+                            names=[], serials=[], type_=None)
+        racks = self._call('rack_list', detailed=False)
+        meta = inventory.write(path, self.location, servers, assets, racks)
+        meta['path'] = path
+        self._print_result(args, meta)
+
+    @cli_command
+    @cli_argument('value', help='Serial number, MAC, IP address or name')
+    @cli_argument('--by', default=None, choices=inventory.FIELDS,
+                  help='Optional. Field to search by. All indexed fields are '
+                       'searched by default.')
+    @cli_argument('--kind', default=None, choices=inventory.KINDS,
+                  help='Optional. Limit output to one record kind.')
+    @cli_argument('--snapshot', default=None,
+                  help='Optional. Snapshot file to use.')
+    @cli_usage(['Snapshot is to be created by dao snapshot command.',
+                'Examples:',
+                'dao lookup 11:22:33:44:55:66',
+                'dao lookup D81PW12 --by serial --kind server'])
+    def lookup(self, args):
+        """Find servers, assets and racks in the local snapshot"""
+        fields = [args.by] if args.by else inventory.FIELDS
+        result = dict()
+        with inventory.Snapshot(self._snapshot_path(args.snapshot)) as snap:
+            for field in fields:
+                for kind, id_, record in snap.lookup(field, args.value,
+                                                     args.kind):
+                    result[u'{0}:{1}'.format(kind, id_)] = record
+        self._print_result(args, result)
+
     @cli_command
     @cli_argument('serial')
     @cli_argument('name')
@@ -624,6 +856,110 @@ class DAOClient(object):
                          os_name=args.os_name)
         self._print_result(args, oss)
 
+    @cli_command
+    @cli_argument('new', help='Snapshot or saved json result (after)')
+    @cli_argument('old', help='Snapshot or saved json result (before)')
+    @cli_argument('--key', default='serial', choices=['serial', 'name', 'id'],
+                  help='Optional. Field to match records by. Records without '
+                       'serial are matched by name, without name - by id. '
+                       'Keys shared by several records are reported as '
+                       'ambiguous. Default: serial')
+    @cli_argument('--kind', default='server', choices=inventory.KINDS,
+                  help='Optional. Record kind to compare for snapshots. '
+                       'Default: server')
+    @cli_usage(['Saved results are produced by '
+                'dao --format json server-list > before.json',
+                'Snapshots are produced by dao snapshot --output before.snap',
+                'Example:',
+                'dao diff before.snap after.snap'])
+    def diff(self, args):
+        """Compare two inventory snapshots or saved results"""
+        result = dict(added=[], removed=[], changed=dict(), ambiguous=[])
+        old = inventory.open_source(args.old, args.kind)
+        try:
+            new = inventory.open_source(args.new, args.kind)
+            try:
+                for state, key, changes in inventory.diff(old, new, args.key):
+                    if state == 'changed':
+                        result['changed'][key] = changes
+                    else:
+                        result[state].append(key)
+            finally:
+                new.close()
+        finally:
+            old.close()
+        result['added'].sort()
+        result['removed'].sort()
+        result['ambiguous'].sort()
+        self._print_result(args, result)
+
+    @cli_command
+    @cli_argument('--mix', default=bench.DEFAULT_MIX,
+                  help='Optional. Weighted read tasks to send, '
+                       'func=weight comma separated. Available: ' +
+                       ', '.join(sorted(bench.READ_TASKS)) +
+                       '. Default: ' + bench.DEFAULT_MIX)
+    @cli_argument('--replay', default=None,
+                  help='Optional. Replay tasks recorded with dao --record '
+                       'instead of --mix, in recorded order and with '
+                       'recorded intervals unless --rate is set.')
+    @cli_argument('--speed', type=float, default=1.0,
+                  help='Optional. Replay speed factor, 2 replays recorded '
+                       'traffic twice as fast. Default: 1')
+    @cli_argument('--allow-write', action='store_true', default=False,
+                  help='Allow replaying tasks that modify master state. '
+                       'Never use it against production master.')
+    @cli_argument('--concurrency', type=int, default=4,
+                  help='Optional. Number of parallel requests. Default: 4')
+    @cli_argument('--rate', type=float, default=None,
+                  help='Optional. Target rate, requests per second. '
+                       'Requests are sent back to back if not set. '
+                       'Overrides recorded intervals of --replay.')
+    @cli_argument('--duration', type=float, default=None,
+                  help='Optional. Bench duration in seconds. Default: 10 '
+                       'unless --requests is set')
+    @cli_argument('--requests', type=int, default=None,
+                  help='Optional. Total number of requests to send.')
+    @cli_argument('--timeout', type=float, default=30.0,
+                  help='Optional. Request timeout in seconds. Default: 30')
+    @cli_usage(['Examples:',
+                ' dao bench --mix worker_list=3,servers_list=1 --rate 50',
+                ' dao --record prod.jsonl server-list --rack PHX2-A1',
+                ' dao bench --replay prod.jsonl --concurrency 16 '
+                '--speed 5 --requests 10000'])
+    def bench(self, args):
+        """Generate load on the master and report throughput, errors and
+        latency per task"""
+        if args.concurrency < 1:
+            self.parser.error('--concurrency should be positive')
+        if args.speed <= 0:
+            self.parser.error('--speed should be positive')
+        if args.replay:
+            tasks = bench.load_replay(args.replay)
+            writes = sorted(set(t['func'] for t in tasks if bench.is_write(t)))
+            if writes and not args.allow_write:
+                self.parser.error('Replay contains write tasks: {0}. Use '
+                                  '--allow-write to send them.'.format(
+                                      ', '.join(writes)))
+        else:
+            tasks = bench.parse_mix(args.mix)
+        duration = args.duration
+        if duration is None and args.requests is None:
+            duration = 10.0
+
+        def send(task):
+            r = self._request(task['func'], task['args'], task['kwargs'],
+                              timeout=args.timeout, retry=False)
+            if not 200 <= r.status_code < 300:
+                return 'http_{0}'.format(r.status_code)
+
+        runner = bench.Bench(send, tasks, args.concurrency,
+                             rate=args.rate, duration=duration,
+                             requests=args.requests,
+                             replay=bool(args.replay),
+                             speed=args.speed)
+        self._print_result(args, runner.run())
+
     def _print_result(self, args, result):
         """Print result in a format defined by self.print_format"""
         if result is None:
@@ -698,6 +1034,12 @@ def get_parser():
                              'An example: asset.serial,pxe_ip')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Provide an extended error output')
+    parser.add_argument('--record', default=None,
+                        help='Append every task sent to the master to the '
+                             'file. Can be replayed with dao bench --replay')
+    parser.add_argument('--master-url', default=None,
+                        help='DAO Master URL to use instead of configured '
+                             'ones')
     parser.add_argument('--location', default=None,
                         help='Location. Can be set in client.cfg'.
                         format(CONF.client.location_var))
@@ -727,13 +1069,22 @@ def run():
                      format(CONF.client.location_var))
     argparse.ArgumentTypeError('Value has to be between 0 and 1' )
     sub_parser = parser.get_subparsers('command').choices[args.command]
-    cli = DAOClient(args.format, user, dao_location, sub_parser)
+    cli = DAOClient(args.format, user, dao_location, sub_parser,
+                    record=args.record, master_url=args.master_url)
     try:
         HANDLERS[args.command](cli, args)
     except exceptions.DAOTimeout:
         msg = 'DAO Master at {ip} could not be reached: timeout'.format(
-            ip=CONF.client.master_url)
+            ip=', '.join(cli.router.urls))
         logger.error(msg)
+        sys.exit(1)
+    except requests.ConnectionError as exc:
+        msg = 'DAO Master at {ip} could not be reached: {exc}'.format(
+            ip=', '.join(cli.router.urls), exc=exc)
+        logger.error(msg)
+        sys.exit(1)
+    finally:
+        cli.router.save_state()
 
 
 if __name__ == '__main__':
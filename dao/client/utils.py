@@ -0,0 +1,85 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import math
+import os
+import Queue
+import threading
+
+
+def percentile(values, pct):
+    """Return nearest-rank percentile of values, None for empty input"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def latency_summary(values):
+    """Build min/max/p50/p95/p99 summary (milliseconds) for the values"""
+    if not values:
+        return dict(count=0)
+    return dict(count=len(values),
+                min=round(min(values), 3),
+                max=round(max(values), 3),
+                p50=round(percentile(values, 50), 3),
+                p95=round(percentile(values, 95), 3),
+                p99=round(percentile(values, 99), 3))
+
+
+def parallel_map(func, items, concurrency):
+    """Apply func to every item using a pool of threads.
+    Results are returned in order of items. If func raises, the exception
+    object is returned instead of the result.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as exc:
+                results[index] = exc
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(concurrency, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with timeout keeps main thread responsive to Ctrl+C
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+def dump_json(path, data):
+    """Write json file atomically, creating directory if required"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
@@ -27,6 +27,8 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=install_requires,
     tests_require=['pytest'],
-    entry_points={'console_scripts': ['dao = dao.client.shell:run']},
+    entry_points={'console_scripts': [
+        'dao = dao.client.shell:run',
+        'dao-complete = dao.client.completion:run']},
     data_files=[('/etc/dao', ['etc/client.cfg', 'etc/client-logger.cfg'])]
 )
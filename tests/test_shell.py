@@ -0,0 +1,28 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pytest
+
+pytest.importorskip('dao.common')
+
+from dao.client import shell
+
+
+def test_diff_usage_example_order():
+    """Positionals of dao diff follow the documented usage example"""
+    example = shell.DAOClient.diff.cli_usage[-1]
+    assert example == 'dao diff before.snap after.snap'
+    args = shell.get_parser().parse_args(example.split()[1:])
+    assert args.old == 'before.snap'
+    assert args.new == 'after.snap'